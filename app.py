@@ -3,11 +3,22 @@ import os
 from datetime import datetime, date
 from functools import wraps
 import random
-from flask import Flask, render_template, request, redirect, url_for, session, flash, g, jsonify, send_file, abort
+import sqlite3
+import threading
+import time
+import zlib
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, jsonify, send_file, abort, has_request_context, stream_template, Response
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from sqlalchemy import func
+from sqlalchemy import func, event, and_, text, inspect as sa_inspect
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql.functions import GenericFunction
+from bisect import bisect_left
 
 # Flask app
 app = Flask(__name__)
@@ -22,7 +33,118 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 ALLOWED_EXTENSIONS = {"db"}
 
-db = SQLAlchemy(app)
+# --- Read replica ---
+# GETs of read-only views query the replica while its measured lag is within
+# REPLICA_MAX_LAG seconds. Lag is measured on Postgres standbys; the single node
+# SQLite pool has none. Other replicas can't be measured and are only used with
+# REPLICA_MAX_LAG=inf. For READ_YOUR_WRITES_SECONDS after a user's own write their
+# reads stay on the primary.
+app.config['REPLICA_MAX_LAG'] = float(os.environ.get('REPLICA_MAX_LAG', 5))
+app.config['READ_YOUR_WRITES_SECONDS'] = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+REPLICA_LAG_CHECK_INTERVAL = 1
+replica_lag_value = 0.0
+replica_lag_checked_at = float('-inf')
+
+def replica_uri(primary_uri):
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        return os.environ['DATABASE_REPLICA_URL']
+    # Single node SQLite: a read-only connection pool on the same file
+    url = make_url(primary_uri)
+    if url.drivername.startswith('sqlite') and url.database and url.database != ':memory:':
+        path = url.database if os.path.isabs(url.database) else os.path.join(app.instance_path, url.database)
+        return f"sqlite:///file:{path}?mode=ro&uri=true"
+    return None
+
+REPLICA_URI = replica_uri(app.config['SQLALCHEMY_DATABASE_URI'])
+REPLICA_IS_PRIMARY_FILE = REPLICA_URI is not None and not os.environ.get('DATABASE_REPLICA_URL')
+if REPLICA_URI:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': REPLICA_URI}
+    if (not REPLICA_IS_PRIMARY_FILE and make_url(REPLICA_URI).get_backend_name() != 'postgresql'
+            and app.config['REPLICA_MAX_LAG'] != float('inf')):
+        app.logger.warning("Replica lag can't be measured for %s; reads stay on the primary unless REPLICA_MAX_LAG=inf",
+                           make_url(REPLICA_URI).get_backend_name())
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_request_context()
+                and g.get('read_replica') and 'replica' in self._db.engines):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+def measure_replica_lag():
+    if REPLICA_IS_PRIMARY_FILE:
+        return 0.0
+    engine = db.engines['replica']
+    if engine.dialect.name != 'postgresql':
+        return float('inf')
+    # An idle primary also makes a standby look behind; reads then use the primary
+    lag_sql = text(
+        "SELECT CASE WHEN pg_is_in_recovery() "
+        "THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) ELSE 0 END"
+    )
+    try:
+        with engine.connect() as conn:
+            lag = conn.execute(lag_sql).scalar()
+    except SQLAlchemyError:
+        app.logger.warning("Could not measure replica lag; reading from the primary", exc_info=True)
+        return float('inf')
+    return float('inf') if lag is None else float(lag)
+
+def replica_lag():
+    global replica_lag_value, replica_lag_checked_at
+    now = time.monotonic()
+    if now - replica_lag_checked_at >= REPLICA_LAG_CHECK_INTERVAL:
+        replica_lag_value = measure_replica_lag()
+        replica_lag_checked_at = now
+    return replica_lag_value
+
+def use_replica():
+    view = app.view_functions.get(request.endpoint)
+    if request.method != 'GET' or not getattr(view, 'read_replica', False) or 'replica' not in db.engines:
+        return False
+    if time.time() - session.get('last_write_at', 0) <= app.config['READ_YOUR_WRITES_SECONDS']:
+        return False
+    return replica_lag() <= app.config['REPLICA_MAX_LAG']
+
+@event.listens_for(db.session, 'after_commit')
+def remember_write(db_session):
+    if has_request_context():
+        session['last_write_at'] = time.time()
+
+# lower() for username search. SQLite's builtin lower() only handles ASCII, so SQLite
+# connections get unicode_lower (Python's str.lower); Postgres lower() follows the
+# database locale, which matches str.lower() for Å/Ä/Ö under a UTF-8 locale.
+class username_key(GenericFunction):
+    type = db.String()
+    inherit_cache = True
+
+@compiles(username_key)
+def compile_username_key(element, compiler, **kw):
+    return f"lower({compiler.process(element.clauses, **kw)})"
+
+@compiles(username_key, 'sqlite')
+def compile_username_key_sqlite(element, compiler, **kw):
+    return f"unicode_lower({compiler.process(element.clauses, **kw)})"
+
+@event.listens_for(Engine, 'connect')
+def register_sqlite_functions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(
+            'unicode_lower', 1, lambda value: value.lower() if value is not None else None, deterministic=True
+        )
+
+# Streamed pages keep a read cursor open while the client downloads; in WAL mode
+# that doesn't block writers the way SQLite's default rollback journal does
+def enable_sqlite_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', enable_sqlite_wal)
 
 # Models
 class User(db.Model):
@@ -35,6 +157,10 @@ class User(db.Model):
     received_transactions = db.relationship('Transaction', foreign_keys='Transaction.receiver_id', backref='receiver', lazy=True)
     messages = db.relationship('Message', backref='user', lazy=True)
     snake_scores = db.relationship('SnakeScore', backref='user', lazy=True)
+    __table_args__ = (
+        db.Index('ix_user_username_key', username_key(username).label('username_key'),
+                 postgresql_ops={'username_key': 'text_pattern_ops'}),
+    )
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -75,8 +201,15 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Mark a read-only view; load_logged_in_user routes its GETs to the replica
+def read_replica(f):
+    f.read_replica = True
+    return f
+
 @app.before_request
 def load_logged_in_user():
+    # Decided before loading g.user so the user and the page come from the same database
+    g.read_replica = use_replica()
     user_id = session.get('user_id')
     g.user = User.query.get(user_id) if user_id else None
 
@@ -84,12 +217,195 @@ def load_logged_in_user():
 @app.cli.command('init-db')
 def init_db():
     db.create_all()
+    # create_all skips indexes on tables that already exist, and SQLite can't
+    # reflect expression indexes, so checkfirst doesn't work here
+    with db.engine.begin() as conn:
+        for index in User.__table__.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+    build_username_index()
     print("Databasen är skapad!")
 
 # --- Utility ---
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- Username search index ---
+# Sorted (lowercase, username) tuples so a prefix lookup is a bisect + short scan.
+# Each worker keeps its own copy. At most every USERNAME_INDEX_TTL seconds a search
+# starts a background refresh: users added since the last known max id are inserted,
+# anything else (deletes, an uploaded DB) triggers a full rebuild.
+USERNAME_INDEX = []
+username_index_ready = False
+username_index_watermark = None
+username_index_checked_at = 0.0
+username_index_lock = threading.Lock()
+USERNAME_INDEX_TTL = 5
+USER_SEARCH_LIMIT = 10
+MAX_CHAR = chr(0x10FFFF)
+
+def username_watermark():
+    return tuple(db.session.query(func.count(User.id), func.max(User.id)).one())
+
+def insert_username(name):
+    entry = (name.lower(), name)
+    i = bisect_left(USERNAME_INDEX, entry)
+    if i == len(USERNAME_INDEX) or USERNAME_INDEX[i] != entry:
+        USERNAME_INDEX.insert(i, entry)
+
+def build_username_index():
+    global username_index_ready, username_index_watermark, username_index_checked_at
+    watermark = username_watermark()
+    names = db.session.query(User.username).all()
+    USERNAME_INDEX[:] = sorted((name.lower(), name) for (name,) in names)
+    username_index_watermark = watermark
+    username_index_checked_at = time.monotonic()
+    username_index_ready = True
+
+def add_to_username_index(user):
+    # The watermark is left alone; the next refresh sees the row and skips the duplicate
+    if username_index_ready:
+        insert_username(user.username)
+
+def catch_up_username_index():
+    global username_index_watermark
+    count, max_id = username_watermark()
+    known_count, known_max_id = username_index_watermark
+    if (count, max_id) == (known_count, known_max_id):
+        return
+    if (max_id or 0) > (known_max_id or 0):
+        added = db.session.query(User.id, User.username).filter(User.id > (known_max_id or 0)).all()
+        if known_count + len(added) == count:
+            for _, name in added:
+                insert_username(name)
+            username_index_watermark = (count, max(user_id for user_id, _ in added))
+            return
+    build_username_index()
+
+def run_username_index_refresh():
+    try:
+        with app.app_context():
+            catch_up_username_index()
+    except SQLAlchemyError:
+        app.logger.warning("Refreshing the username index failed", exc_info=True)
+    finally:
+        username_index_lock.release()
+
+def refresh_username_index():
+    global username_index_checked_at
+    now = time.monotonic()
+    if now - username_index_checked_at < USERNAME_INDEX_TTL or not username_index_lock.acquire(blocking=False):
+        return
+    username_index_checked_at = now
+    threading.Thread(target=run_username_index_refresh, daemon=True).start()
+
+def search_usernames(prefix, limit=USER_SEARCH_LIMIT):
+    key = prefix.lower()
+    if username_index_ready:
+        refresh_username_index()
+        matches = []
+        i = bisect_left(USERNAME_INDEX, (key,))
+        while i < len(USERNAME_INDEX) and len(matches) < limit and USERNAME_INDEX[i][0].startswith(key):
+            matches.append(USERNAME_INDEX[i][1])
+            i += 1
+        return matches
+    # Cold worker: seek on the username_key index in the DB, in the same order as the index
+    lowered = username_key(User.username)
+    if db.engine.dialect.name == 'postgresql':
+        # Prefix LIKE seeks on the text_pattern_ops index; "C" orders by code point like Python
+        pattern = key.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        condition = lowered.like(pattern, escape='\\')
+        order = (lowered.collate('C'), User.username.collate('C'))
+    else:
+        condition = and_(lowered >= key, lowered < key + MAX_CHAR)
+        order = (lowered, User.username)
+    rows = db.session.query(User.username).filter(condition).order_by(*order).limit(limit).all()
+    return [name for (name,) in rows]
+
+with app.app_context():
+    if sa_inspect(db.engine).has_table(User.__tablename__):
+        build_username_index()
+    else:
+        app.logger.warning("No user table yet (run `flask init-db`); username search uses the DB")
+
+# --- Streamed pages ---
+# Large pages iterate their queries in batches and send the template as it renders.
+app.config['STREAM_PAGES'] = os.environ.get('STREAM_PAGES', '0') == '1'
+STREAM_BATCH_SIZE = 200
+STREAM_BUFFER_SIZE = 8192
+_NO_ROW = object()
+
+class StreamedRows:
+    # Single pass over query.yield_per(); truthy if the query has any row
+    def __init__(self, query, batch_size=STREAM_BATCH_SIZE):
+        self.query = query
+        self.batch_size = batch_size
+        self._rows = None
+        self._head = _NO_ROW
+
+    def _start(self):
+        if self._rows is None:
+            self._rows = iter(self.query.yield_per(self.batch_size))
+            self._head = next(self._rows, _NO_ROW)
+
+    def __bool__(self):
+        self._start()
+        return self._head is not _NO_ROW
+
+    def __iter__(self):
+        self._start()
+        if self._head is not _NO_ROW:
+            yield self._head
+            self._head = _NO_ROW
+        yield from self._rows
+
+    def close(self):
+        # Closing the query generator closes its cursor
+        if self._rows is not None:
+            self._rows.close()
+
+def fetch_rows(query):
+    if app.config['STREAM_PAGES']:
+        return StreamedRows(query)
+    return query.all()
+
+def buffered_stream(chunks, compress=False, buffer_size=STREAM_BUFFER_SIZE):
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31: gzip container
+    buffer, size = [], 0
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= buffer_size:
+            data = b''.join(buffer)
+            yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+            buffer, size = [], 0
+    data = b''.join(buffer)
+    yield compressor.compress(data) + compressor.flush() if compressor else data
+
+def stream_page(path, chunks, rows, compress):
+    # The status line is already sent, so a failure can only truncate the page; log it
+    try:
+        yield from buffered_stream(chunks, compress)
+    except Exception:
+        app.logger.exception("Streaming %s failed, the client got a truncated page", path)
+        raise
+    finally:
+        for streamed in rows:
+            streamed.close()
+        chunks.close()
+
+def render_page(template, **context):
+    if not app.config['STREAM_PAGES']:
+        return render_template(template, **context)
+    compress = 'gzip' in request.accept_encodings
+    rows = [value for value in context.values() if isinstance(value, StreamedRows)]
+    body = stream_page(request.path, stream_template(template, **context), rows, compress)
+    response = Response(body, mimetype='text/html')
+    response.vary.add('Accept-Encoding')
+    if compress:
+        response.content_encoding = 'gzip'
+    return response
+
 # --- Routes ---
 @app.route('/')
 def index():
@@ -116,6 +432,7 @@ def register():
         new_user.set_password(password)
         db.session.add(new_user)
         db.session.commit()
+        add_to_username_index(new_user)
         flash('Registrering lyckades. Logga in.', 'success')
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -176,12 +493,21 @@ def dashboard():
         return redirect(url_for('dashboard'))
     return render_template('dashboard.html', user=g.user)
 
+@app.route('/users/search')
+@login_required
+def users_search():
+    prefix = request.args.get('prefix', '').strip()
+    if not prefix:
+        return jsonify({'users': []})
+    return jsonify({'users': search_usernames(prefix)})
+
 @app.route('/transactions')
 @login_required
+@read_replica
 def transactions():
-    sent = Transaction.query.filter_by(sender_id=g.user.id).order_by(Transaction.timestamp.desc()).all()
-    received = Transaction.query.filter_by(receiver_id=g.user.id).order_by(Transaction.timestamp.desc()).all()
-    return render_template('transactions.html', sent=sent, received=received, user=g.user)
+    sent = fetch_rows(Transaction.query.filter_by(sender_id=g.user.id).order_by(Transaction.timestamp.desc()))
+    received = fetch_rows(Transaction.query.filter_by(receiver_id=g.user.id).order_by(Transaction.timestamp.desc()))
+    return render_page('transactions.html', sent=sent, received=received, user=g.user)
 
 @app.route('/change_password', methods=['GET', 'POST'])
 @login_required
@@ -236,6 +562,7 @@ def dice():
 
 @app.route('/chat', methods=['GET', 'POST'])
 @login_required
+@read_replica
 def chat():
     if request.method == 'POST':
         content = request.form.get('message', '').strip()
@@ -256,51 +583,48 @@ from datetime import date
 # --- Snake leaderboard page ---
 @app.route('/snake', methods=['GET'])
 @login_required
+@read_replica
 def snake():
     today = date.today()
 
     # Today Total
-    today_total = (
+    today_total = fetch_rows(
         db.session.query(User.username, func.sum(SnakeScore.score).label('total'))
         .join(SnakeScore)
         .filter(SnakeScore.date == today)
         .group_by(User.id)
         .order_by(func.sum(SnakeScore.score).desc())
-        .all()
     )
 
     # Today Highscore
-    today_highscore = (
+    today_highscore = fetch_rows(
         db.session.query(User.username, func.max(SnakeScore.score).label('highscore'))
         .join(SnakeScore)
         .filter(SnakeScore.date == today)
         .group_by(User.id)
         .order_by(func.max(SnakeScore.score).desc())
-        .all()
     )
 
-    alltime_total = (
+    alltime_total = fetch_rows(
         db.session.query(User.username, func.sum(SnakeScore.score).label('total'))
         .join(SnakeScore)
         .group_by(User.id)
         .order_by(func.sum(SnakeScore.score).desc())
-        .all()
     )
 
     # All-time Highscore
-    alltime_highscore = (
+    alltime_highscore = fetch_rows(
         db.session.query(User.username, func.max(SnakeScore.score).label('highscore'))
         .join(SnakeScore)
         .group_by(User.id)
         .order_by(func.max(SnakeScore.score).desc())
-        .all()
     )
 
     user_highscore = db.session.query(func.max(SnakeScore.score)).filter(
         SnakeScore.user_id == g.user.id
     ).scalar() or 0
 
-    return render_template(
+    return render_page(
         'snake.html',
         today_total=today_total,
         today_highscore=today_highscore,
@@ -399,9 +723,10 @@ class MarketplaceItem(db.Model):
 
 @app.route('/marketplace')
 @login_required
+@read_replica
 def marketplace():
-    items = MarketplaceItem.query.filter_by(buyer_id=None).order_by(MarketplaceItem.created_at.desc()).all()
-    return render_template('marketplace.html', items=items, user=g.user)
+    items = fetch_rows(MarketplaceItem.query.filter_by(buyer_id=None).order_by(MarketplaceItem.created_at.desc()))
+    return render_page('marketplace.html', items=items, user=g.user)
 
 @app.route('/marketplace/add', methods=['GET', 'POST'])
 @login_required
@@ -526,6 +851,7 @@ def admin_upload_db():
 
             # Overwrite active cloud DB
             shutil.copy(temp_path, ACTIVE_DB_PATH)
+            build_username_index()
 
             flash("Database successfully uploaded and active!", "success")
             return redirect(url_for("admin_upload_db"))
@@ -548,6 +874,7 @@ def reset_coins():
 
 @app.route('/admin/view-leaderboard')
 @login_required
+@read_replica
 def view_leaderboard():
     if g.user.username != ADMIN_USERNAME:
         abort(403)
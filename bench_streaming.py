@@ -0,0 +1,80 @@
+# bench_streaming.py
+# Compares peak RSS and time to first byte of /transactions, buffered vs streamed.
+# Each mode runs in its own process so ru_maxrss is not shared between them.
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+N_TRANSACTIONS = 50_000
+
+
+def seed(db_path):
+    os.environ['DATABASE_URL'] = f"sqlite:///{db_path}"
+    from app import app, db, User, Transaction
+    with app.app_context():
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [
+            {'id': 1, 'username': 'Axel', 'password_hash': 'x', 'coins': 500},
+            {'id': 2, 'username': 'William', 'password_hash': 'x', 'coins': 500},
+        ])
+        db.session.execute(Transaction.__table__.insert(), [
+            {'sender_id': 1 + i % 2, 'receiver_id': 2 - i % 2, 'amount': i % 100 + 1}
+            for i in range(N_TRANSACTIONS)
+        ])
+        db.session.commit()
+
+
+def measure():
+    from app import app
+    # base.html links to a 'bank' page that has no route yet
+    app.add_url_rule('/bank', 'bank', lambda: '')
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s['user_id'] = 1
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    response = client.get('/transactions', buffered=False, headers={'Accept-Encoding': 'gzip'})
+    body = iter(response.response)
+    size = len(next(body))
+    ttfb = time.perf_counter() - start
+    for chunk in body:
+        size += len(chunk)
+    total = time.perf_counter() - start
+    response.close()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(json.dumps({
+        'ttfb_ms': ttfb * 1000,
+        'total_ms': total * 1000,
+        'peak_rss_delta_mb': (rss_after - rss_before) / 1024,
+        'bytes': size,
+        'encoding': response.headers.get('Content-Encoding', 'identity'),
+    }))
+
+
+def main():
+    tmp = tempfile.mkdtemp()
+    db_path = os.path.join(tmp, 'bench.db')
+    subprocess.run([sys.executable, __file__, '--seed', db_path], check=True)
+    print(f"/transactions with {N_TRANSACTIONS} transactions")
+    for mode, stream in (('buffered', '0'), ('streamed', '1')):
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}", STREAM_PAGES=stream)
+        out = subprocess.run([sys.executable, __file__, '--measure'], env=env, check=True,
+                             capture_output=True, text=True).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        print(f"{mode:>9}: TTFB {r['ttfb_ms']:8.1f} ms  total {r['total_ms']:8.1f} ms  "
+              f"peak RSS +{r['peak_rss_delta_mb']:6.1f} MB  {r['bytes']} bytes ({r['encoding']})")
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--seed']:
+        seed(sys.argv[2])
+    elif sys.argv[1:2] == ['--measure']:
+        measure()
+    else:
+        main()
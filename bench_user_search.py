@@ -0,0 +1,115 @@
+# bench_user_search.py
+# Times /users/search at 100k users and checks the index against the DB fallback.
+# Runs against a temporary SQLite database, never instance/database.db.
+import os
+import random
+import string
+import tempfile
+import time
+
+from sqlalchemy import event
+
+tmp = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+
+import app as coin_app
+from app import (app, db, User, USERNAME_INDEX, build_username_index, catch_up_username_index,
+                 search_usernames, username_index_lock)
+
+N_USERS = 100_000
+N_QUERIES = 10_000
+N_REQUESTS = 2_000
+N_LATE_USERS = 100
+
+random.seed(0)
+names = {"".join(random.choices(string.ascii_letters + string.digits + "_ÅÄÖåäö", k=random.randint(4, 12)))
+         for _ in range(N_USERS)}
+names |= {"Åsa", "åke", "a_b", "a%b"}
+
+with app.app_context():
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [{'username': name, 'password_hash': 'x'} for name in names])
+    db.session.commit()
+    build_username_index()
+
+prefixes = [name[:random.randint(1, 4)] for name in random.sample(sorted(names), N_QUERIES)]
+prefixes += ["Å", "å", "a_", "a%", "zzzzzz"]
+
+# The index and the DB fallback must return the same names, case-insensitively for Å/Ä/Ö too
+fallback_sql = []
+
+with app.app_context():
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def record(conn, cursor, statement, parameters, context, executemany):
+        fallback_sql.append((statement, parameters))
+
+    for prefix in prefixes[:500] + prefixes[-5:]:
+        coin_app.username_index_ready = True
+        from_index = search_usernames(prefix)
+        coin_app.username_index_ready = False
+        fallback_sql.clear()
+        from_db = search_usernames(prefix)
+        assert from_index == from_db, (prefix, from_index, from_db)
+    coin_app.username_index_ready = True
+    event.remove(db.engine, 'before_cursor_execute', record)
+    assert {'Åsa', 'åke'} <= set(search_usernames('å', limit=N_USERS)) == set(search_usernames('Å', limit=N_USERS))
+
+    # The fallback must seek on the expression index, not scan it
+    statement, parameters = fallback_sql[-1]
+    plan = db.session.execute(db.text("EXPLAIN QUERY PLAN " + statement.replace('?', "'x'"))).all()
+    assert any("SEARCH" in row[-1] and "ix_user_username_key" in row[-1] for row in plan), plan
+
+# A user registered through the app shows up in search
+client = app.test_client()
+client.post('/register', data={'username': 'Zebulon', 'password': 'pw', 'password2': 'pw'})
+with client.session_transaction() as s:
+    s['user_id'] = 1
+assert 'Zebulon' in client.get('/users/search?prefix=zebu').json['users']
+
+# Users inserted behind this worker's back (another worker's registrations) are caught up
+def wait_for_refresh():
+    with username_index_lock:
+        pass
+
+with app.app_context():
+    db.session.execute(User.__table__.insert(), [{'username': 'Zebedee', 'password_hash': 'x'}])
+    db.session.commit()
+coin_app.username_index_checked_at = 0.0
+start = time.perf_counter()
+client.get('/users/search?prefix=zebe')
+refresh_request = time.perf_counter() - start
+wait_for_refresh()
+assert 'Zebedee' in client.get('/users/search?prefix=zebe').json['users']
+assert client.get('/users/search?prefix=zebu').json['users'].count('Zebulon') == 1, 'register + refresh must not duplicate'
+
+with app.app_context():
+    db.session.execute(User.__table__.insert(), [
+        {'username': f'late{i:03}', 'password_hash': 'x'} for i in range(N_LATE_USERS)
+    ])
+    db.session.commit()
+    start = time.perf_counter()
+    catch_up_username_index()
+    catch_up = time.perf_counter() - start
+    assert len(search_usernames('late', limit=N_LATE_USERS)) == N_LATE_USERS
+
+    start = time.perf_counter()
+    build_username_index()
+    rebuild = time.perf_counter() - start
+
+with app.app_context():
+    start = time.perf_counter()
+    for prefix in prefixes:
+        search_usernames(prefix)
+    lookup = (time.perf_counter() - start) / len(prefixes)
+
+start = time.perf_counter()
+for prefix in prefixes[:N_REQUESTS]:
+    response = client.get('/users/search', query_string={'prefix': prefix})
+    assert response.status_code == 200
+request_time = (time.perf_counter() - start) / N_REQUESTS
+
+print(f"{len(USERNAME_INDEX)} users")
+print(f"index lookup:      avg {lookup * 1e6:7.1f} µs")
+print(f"GET /users/search: avg {request_time * 1e6:7.1f} µs (includes Flask and the session user load)")
+print(f"search that starts a refresh: {refresh_request * 1e3:6.1f} ms (refresh runs in a background thread)")
+print(f"catch-up of {N_LATE_USERS} new users: {catch_up * 1e3:6.1f} ms, full rebuild: {rebuild * 1e3:6.1f} ms")
@@ -0,0 +1,79 @@
+# replica_check.py
+# Verifies read/write routing against two local SQLite databases.
+# Records which database every query runs on for a sequence of requests.
+import os
+import tempfile
+
+from sqlalchemy import event
+
+tmp = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'primary.db')}"
+os.environ['DATABASE_REPLICA_URL'] = f"sqlite:///{os.path.join(tmp, 'replica.db')}"
+os.environ['READ_YOUR_WRITES_SECONDS'] = '5'
+# A second SQLite file has no measurable lag, so the bound has to be lifted
+os.environ['REPLICA_MAX_LAG'] = 'inf'
+
+import app as coin_app
+from app import app, db, User, ADMIN_USERNAME
+
+# base.html links to a 'bank' page that has no route yet
+app.add_url_rule('/bank', 'bank', lambda: '')
+
+READ_VIEWS = ['/chat', '/snake', '/transactions', '/marketplace', '/admin/view-leaderboard']
+engines = []
+
+with app.app_context():
+    for name, engine in (('primary', db.engine), ('replica', db.engines['replica'])):
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(User.__table__.insert(), [{'id': 1, 'username': ADMIN_USERNAME, 'password_hash': 'x', 'coins': 500}])
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def record(conn, cursor, statement, parameters, context, executemany, name=name):
+            engines.append(name)
+
+def engines_used(method, path, **kwargs):
+    engines.clear()
+    response = client.open(path, method=method, **kwargs)
+    assert response.status_code in (200, 302), f'{method} {path} returned {response.status_code}'
+    return set(engines)
+
+def age_last_write():
+    with client.session_transaction() as s:
+        s['last_write_at'] -= app.config['READ_YOUR_WRITES_SECONDS'] + 1
+
+client = app.test_client()
+with client.session_transaction() as s:
+    s['user_id'] = 1
+
+for path in READ_VIEWS:
+    assert engines_used('GET', path) == {'replica'}, f'GET {path} should read only from the replica'
+
+assert engines_used('POST', '/chat', data={'message': 'hej'}) == {'primary'}, 'writes should hit the primary'
+for path in READ_VIEWS:
+    assert engines_used('GET', path) == {'primary'}, f'read-after-write on {path} should stay on the primary'
+
+age_last_write()
+for path in READ_VIEWS:
+    assert engines_used('GET', path) == {'replica'}, f'{path} should return to the replica after the window'
+
+# With a finite bound an unmeasurable replica is never read
+app.config['REPLICA_MAX_LAG'] = 5
+coin_app.replica_lag_checked_at = float('-inf')
+assert engines_used('GET', '/snake') == {'primary'}, 'an unmeasurable replica should not be read'
+
+# A replica behind REPLICA_MAX_LAG is skipped until it catches up
+measure_replica_lag = coin_app.measure_replica_lag
+coin_app.measure_replica_lag = lambda: app.config['REPLICA_MAX_LAG'] + 1
+coin_app.replica_lag_checked_at = float('-inf')
+assert engines_used('GET', '/snake') == {'primary'}, 'a lagging replica should not be read'
+coin_app.measure_replica_lag = lambda: 0.0
+coin_app.replica_lag_checked_at = float('-inf')
+assert engines_used('GET', '/snake') == {'replica'}, 'reads should return once the replica catches up'
+coin_app.measure_replica_lag = measure_replica_lag
+app.config['REPLICA_MAX_LAG'] = float('inf')
+
+# Views that are not marked read-only never touch the replica
+assert engines_used('GET', '/dashboard') == {'primary'}
+
+print('Read/write routing OK')
@@ -0,0 +1,130 @@
+# stream_check.py
+# Verifies that streamed pages match the buffered render, with and without gzip,
+# that a streamed page closes its query when it fails or the client leaves, and
+# that writers can commit while a stream is open.
+import gzip
+import logging
+import os
+import sqlite3
+import tempfile
+from datetime import date, timedelta
+
+tmp = tempfile.mkdtemp()
+db_path = os.path.join(tmp, 'stream.db')
+os.environ['DATABASE_URL'] = f"sqlite:///{db_path}"
+
+from app import app, db, User, Transaction, SnakeScore, MarketplaceItem, StreamedRows, render_page
+
+# base.html links to a 'bank' page that has no route yet
+app.add_url_rule('/bank', 'bank', lambda: '')
+
+PAGES = ['/transactions', '/snake', '/marketplace']
+
+# Streams transactions.html over a query that records when it is closed
+closed = []
+
+class TrackedQuery:
+    def __init__(self, fail):
+        self.fail = fail
+
+    def yield_per(self, n):
+        def rows():
+            try:
+                yield from Transaction.query.filter_by(sender_id=1)
+                if self.fail:
+                    raise RuntimeError('lazy load failed')
+            finally:
+                closed.append(self.fail)
+        return rows()
+
+@app.route('/stream-check/<int:fail>')
+def stream_check(fail):
+    rows = StreamedRows(TrackedQuery(bool(fail)))
+    return render_page('transactions.html', sent=rows, received=[], user=db.session.get(User, 1))
+
+with app.app_context():
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [
+        {'id': 1, 'username': 'Axel', 'password_hash': 'x', 'coins': 500},
+        {'id': 2, 'username': 'William', 'password_hash': 'x', 'coins': 500},
+        {'id': 3, 'username': 'viggo3', 'password_hash': 'x', 'coins': 500},
+    ])
+    db.session.execute(Transaction.__table__.insert(), [
+        {'sender_id': 1 + i % 2, 'receiver_id': 2 - i % 2, 'amount': i + 1} for i in range(500)
+    ])
+    # Only past scores: the all-time tables have rows, today's take the {% else %} branch
+    db.session.execute(SnakeScore.__table__.insert(), [
+        {'user_id': 1 + i % 3, 'score': i % 40, 'date': date.today() - timedelta(days=1 + i % 5)} for i in range(300)
+    ])
+    # Unsold items from several sellers render item.seller through a lazy load
+    db.session.execute(MarketplaceItem.__table__.insert(), [
+        {'seller_id': 1 + i % 3, 'title': f'Objekt {i}', 'description': 'Beskrivning', 'price': 10 + i,
+         'image_filename': f'{i}.png' if i % 2 else None}
+        for i in range(60)
+    ])
+    db.session.commit()
+
+client = app.test_client()
+
+def fetch(path, stream, **headers):
+    app.config['STREAM_PAGES'] = stream
+    # Read each body before the next request so their streams don't interleave
+    response = client.get(path, headers=headers, buffered=True)
+    assert response.status_code == 200, f'{path} returned {response.status_code}'
+    return response
+
+# User 1 has transactions, user 3 has none (empty {% if %} branches)
+for user_id in (1, 3):
+    with client.session_transaction() as s:
+        s['user_id'] = user_id
+    for path in PAGES:
+        buffered = fetch(path, False).data
+        zipped = fetch(path, True, **{'Accept-Encoding': 'gzip'})
+        plain = fetch(path, True)
+        assert zipped.headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Encoding' not in plain.headers, 'clients without gzip should get identity'
+        assert gzip.decompress(zipped.data) == buffered, f'gzipped {path} differs from the buffered render'
+        assert plain.data == buffered, f'streamed {path} differs from the buffered render'
+
+    assert 'Objekt 5' in fetch('/marketplace', True).get_data(as_text=True), 'marketplace should render items'
+    assert 'William' in fetch('/snake', True).get_data(as_text=True), 'snake should render all-time scores'
+    page = fetch('/transactions', True).get_data(as_text=True)
+    assert ('Inga skickade transaktioner.' in page) == (user_id == 3)
+
+# Another connection can commit while a streamed page is half read
+app.config['STREAM_PAGES'] = True
+with client.session_transaction() as s:
+    s['user_id'] = 1
+response = client.get('/transactions', buffered=False)
+body = iter(response.response)
+next(body)
+writer = sqlite3.connect(db_path, timeout=1)
+writer.execute("UPDATE user SET coins = coins + 1 WHERE id = 2")
+writer.commit()
+writer.close()
+for chunk in body:
+    pass
+response.close()
+
+# A failing or abandoned stream closes its query
+failures = []
+handler = logging.Handler()
+handler.emit = failures.append
+app.logger.addHandler(handler)
+app.config['STREAM_PAGES'] = True
+
+response = client.get('/stream-check/1', buffered=False)
+try:
+    for chunk in response.response:
+        pass
+    raise AssertionError('a failing stream should raise')
+except RuntimeError:
+    pass
+assert closed == [True] and any('truncated' in r.getMessage() for r in failures)
+
+response = client.get('/stream-check/0', buffered=False)
+next(iter(response.response))
+response.close()
+assert closed == [True, False], 'an abandoned stream should close its query'
+
+print('Streaming OK')